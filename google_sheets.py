@@ -1,18 +1,87 @@
 import os
 import json
-from datetime import datetime
+import atexit
+import logging
+import random
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import gspread
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
 
+logger = logging.getLogger(__name__)
+
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Buffered leads are written in one append call once either limit is hit
+FLUSH_INTERVAL_SECONDS = 0.5
+FLUSH_MAX_ROWS = 50
+
+# Transient Sheets errors are retried with jittered exponential backoff;
+# anything else (or retries used up) is parked in FAILED_LEADS_PATH
+RETRY_STATUS_CODES = {429, 500, 503}
+FLUSH_RETRIES = 5
+FLUSH_RETRY_MAX_WAIT = 30
+FAILED_LEADS_PATH = os.getenv("FAILED_LEADS_PATH", "failed_leads.jsonl")
+
+# Keep-alive pool for the gspread session; connect errors only are
+# retried here since append is not idempotent
+HTTP_POOL_SIZE = 20
+
+# Access token can be cached on disk so a restart can skip minting a new
+# one. Off unless GOOGLE_TOKEN_CACHE names a file in an app-owned
+# directory (created 0700 if missing); never a shared temp dir.
+TOKEN_CACHE_PATH = os.getenv("GOOGLE_TOKEN_CACHE", "").strip()
+TOKEN_MIN_LIFETIME = timedelta(minutes=5)
+# Google access tokens last at most an hour; a longer expiry is not ours
+TOKEN_MAX_LIFETIME = timedelta(hours=1, minutes=5)
+
+# Authorized credentials / worksheet handle, built once per process
+_CREDS = None
+_WS = None
+_WS_LOCK = threading.Lock()
+
+# (key, default) per sheet column, after the timestamp column
+_ROW_SPEC = (
+    ("name", ""),
+    ("email", ""),
+    ("phone", ""),
+    ("mobile", ""),
+    ("state", ""),
+    ("start_date", ""),
+    ("end_date", ""),
+    ("days", ""),
+    ("travellers", ""),
+    ("rooms", ""),
+    ("hotel_category", ""),
+    ("guide", ""),
+    ("vehicle", ""),
+    ("package", ""),
+    ("source", "website"),
+    ("message", ""),
+    ("status", "New"),
+)
 
 
 def _get_creds():
     """
     Reads service account JSON from env var GOOGLE_SERVICE_ACCOUNT_JSON
     (Render-friendly). Returns Google Credentials.
+    The credentials are cached; google-auth refreshes the token itself.
     """
+    global _CREDS
+    if _CREDS is not None:
+        return _CREDS
+
     raw = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     if not raw:
         raise RuntimeError("Missing environment variable: GOOGLE_SERVICE_ACCOUNT_JSON")
@@ -22,14 +91,102 @@ def _get_creds():
     except Exception as e:
         raise RuntimeError(f"Invalid GOOGLE_SERVICE_ACCOUNT_JSON (must be valid JSON): {e}")
 
-    return Credentials.from_service_account_info(info, scopes=SCOPES)
+    creds = Credentials.from_service_account_info(info, scopes=SCOPES)
+    if TOKEN_CACHE_PATH and not _load_cached_token(creds):
+        creds.refresh(Request())
+        _save_cached_token(creds)
+
+    _CREDS = creds
+    return _CREDS
+
+
+def _load_cached_token(creds) -> bool:
+    """
+    Reuses the access token saved by a previous process if the file is
+    private to this user, belongs to the same service account and its
+    expiry is plausible with at least TOKEN_MIN_LIFETIME left.
+    """
+    try:
+        fd = os.open(TOKEN_CACHE_PATH, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        with os.fdopen(fd) as f:
+            if not _is_private_file(os.fstat(f.fileno())):
+                logger.warning("Ignoring token cache %s: not a private file owned by this user", TOKEN_CACHE_PATH)
+                return False
+            cached = json.load(f)
+        expiry = datetime.fromisoformat(cached["expiry"])
+    except Exception:
+        return False
+
+    if cached.get("account") != creds.service_account_email:
+        return False
+    # google-auth keeps expiry as naive UTC
+    lifetime = expiry - datetime.utcnow()
+    if lifetime <= TOKEN_MIN_LIFETIME or lifetime > TOKEN_MAX_LIFETIME:
+        return False
+
+    creds.token = cached["token"]
+    creds.expiry = expiry
+    return True
+
+
+def _is_private_file(st) -> bool:
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    if hasattr(os, "geteuid"):
+        return st.st_uid == os.geteuid() and not st.st_mode & 0o077
+    return True
+
+
+def _save_cached_token(creds):
+    """
+    Writes the token to a fresh 0600 temp file, then atomically
+    replaces TOKEN_CACHE_PATH with it, so an existing file's
+    owner or mode is never reused.
+    """
+    if not creds.token or not creds.expiry:
+        return
+
+    directory = os.path.dirname(os.path.abspath(TOKEN_CACHE_PATH))
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".hke_gcp_token.")
+    except OSError as e:
+        logger.warning("Could not write token cache %s: %s", TOKEN_CACHE_PATH, e)
+        return
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({
+                "account": creds.service_account_email,
+                "token": creds.token,
+                "expiry": creds.expiry.isoformat(),
+            }, f)
+        os.replace(tmp_path, TOKEN_CACHE_PATH)
+    except OSError as e:
+        logger.warning("Could not write token cache %s: %s", TOKEN_CACHE_PATH, e)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
 
 
 def _get_sheet():
     """
     Opens the Google Sheet + Worksheet using env vars:
     GOOGLE_SHEET_ID, GOOGLE_SHEET_TAB
+    The worksheet handle is opened once and reused by every insert.
     """
+    global _WS
+    if _WS is not None:
+        return _WS
+
+    with _WS_LOCK:
+        if _WS is None:
+            _WS = _open_sheet()
+    return _WS
+
+
+def _open_sheet():
     sheet_id = os.getenv("GOOGLE_SHEET_ID")
     tab_name = os.getenv("GOOGLE_SHEET_TAB")
 
@@ -39,10 +196,148 @@ def _get_sheet():
         raise RuntimeError("Missing environment variable: GOOGLE_SHEET_TAB")
 
     client = gspread.authorize(_get_creds())
+    _mount_pool(client)
     ws = client.open_by_key(sheet_id).worksheet(tab_name)
     return ws
 
 
+def _mount_pool(client):
+    # gspread >= 6 keeps the session on client.http_client
+    session = getattr(client, "http_client", client).session
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3),
+    )
+    session.mount("https://sheets.googleapis.com", adapter)
+
+
+def _timestamp(ts=None) -> str:
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(ts))
+
+
+def _build_row(data: dict) -> list:
+    """
+    Row cells after the timestamp column.
+    """
+    get = data.get
+    return [_cell(get(key, default)) for key, default in _ROW_SPEC]
+
+
+def _cell(v):
+    if isinstance(v, str):
+        return v.strip()
+    return "" if v is None else v
+
+
+class _LeadBuffer:
+    """
+    Collects lead rows in memory and writes them with a single
+    append_rows call (one values:append request) per flush.
+    Rows carry their enqueue time.time(); it is formatted at flush.
+    Flushes run one at a time on a dedicated worker thread, so callers
+    never wait on Sheets and appends land in order.
+    """
+
+    def __init__(self, interval: float, max_rows: int):
+        self.interval = interval
+        self.max_rows = max_rows
+        self._rows = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hke-sheets")
+
+    def add(self, ts: float, cells: list):
+        with self._lock:
+            self._rows.append((ts, cells))
+            full = len(self._rows) >= self.max_rows
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.interval, self._schedule_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        try:
+            fut = self._worker.submit(self.flush)
+        except RuntimeError:
+            # Worker already shut down (interpreter exit): write inline
+            self.flush()
+            return
+        # Nobody waits on the future, so surface failures here
+        fut.add_done_callback(_log_flush_error)
+
+    def flush(self):
+        with self._lock:
+            pending, self._rows = self._rows, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not pending:
+            return
+
+        # Rows queued in the same second share one formatted timestamp
+        stamps = {}
+        rows = []
+        for ts, cells in pending:
+            sec = int(ts)
+            stamp = stamps.get(sec)
+            if stamp is None:
+                stamp = stamps[sec] = _timestamp(sec)
+            rows.append([stamp] + cells)
+
+        _append_rows(rows)
+
+
+def _log_flush_error(fut):
+    e = None if fut.cancelled() else fut.exception()
+    if e is not None:
+        logger.error("Lead flush failed: %s", e, exc_info=e)
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, gspread.exceptions.APIError):
+        return getattr(e.response, "status_code", None) in RETRY_STATUS_CODES
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _append_rows(rows: list) -> bool:
+    """
+    Appends rows in one request, retrying quota / server errors.
+    Rows that still fail are written to FAILED_LEADS_PATH for replay.
+    Returns True if the rows reached the sheet, False if they were parked.
+    """
+    for attempt in range(FLUSH_RETRIES):
+        try:
+            _get_sheet().append_rows(rows, value_input_option="USER_ENTERED")
+            return True
+        except Exception as e:
+            if not _is_retryable(e) or attempt == FLUSH_RETRIES - 1:
+                logger.error("Sheets append failed, parking %d lead rows: %s", len(rows), e)
+                break
+            time.sleep(random.uniform(0, min(FLUSH_RETRY_MAX_WAIT, 2 ** attempt)))
+
+    _park_rows(rows)
+    return False
+
+
+def _park_rows(rows: list):
+    try:
+        # default=str so dates or other non-JSON cells never cost the lead
+        lines = "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows)
+        with open(FAILED_LEADS_PATH, "a", encoding="utf-8") as f:
+            f.write(lines)
+    except Exception as e:
+        # Last resort: put the rows in the log so they can be replayed by hand
+        logger.error("Could not write %s, %d lead rows lost: %s; rows: %r", FAILED_LEADS_PATH, len(rows), e, rows)
+
+
+_BUFFER = _LeadBuffer(FLUSH_INTERVAL_SECONDS, FLUSH_MAX_ROWS)
+
+
 def insert_lead(data: dict):
     """
     Insert one lead row into Google Sheet.
@@ -50,34 +345,49 @@ def insert_lead(data: dict):
     """
 
     ws = _get_sheet()
-
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Safe get helper
-    def g(key, default=""):
-        v = data.get(key, default)
-        return "" if v is None else v
-
-    row = [
-        now,
-        g("name"),
-        g("email"),
-        g("phone"),
-        g("mobile"),
-        g("state"),
-        g("start_date"),
-        g("end_date"),
-        g("days"),
-        g("travellers"),
-        g("rooms"),
-        g("hotel_category"),
-        g("guide"),
-        g("vehicle"),
-        g("package"),
-        g("source", "website"),
-        g("message"),
-        g("status", "New"),
-    ]
-
-    ws.append_row(row, value_input_option="USER_ENTERED")
+    ws.append_row([_timestamp()] + _build_row(data), value_input_option="USER_ENTERED")
     return {"ok": True}
+
+
+def insert_leads_batch(items: list):
+    """
+    Insert several lead rows with a single append request, retrying and
+    parking them like buffered rows. "parked" means they went to
+    FAILED_LEADS_PATH instead of the sheet.
+    """
+
+    if not items:
+        return {"ok": True, "count": 0}
+
+    now = _timestamp()
+    written = _append_rows([[now] + _build_row(data) for data in items])
+    return {"ok": written, "count": len(items), "parked": not written}
+
+
+def insert_lead_async(data: dict):
+    """
+    Queue one lead row and return immediately. Queued rows are written
+    together every FLUSH_INTERVAL_SECONDS or once FLUSH_MAX_ROWS are waiting.
+    """
+
+    _BUFFER.add(time.time(), _build_row(data))
+    return {"ok": True, "queued": True}
+
+
+def warm():
+    """
+    Authorize and open the worksheet ahead of the first insert.
+    """
+
+    _get_sheet()
+
+
+def flush():
+    """
+    Write any queued lead rows now. Call on shutdown so nothing is lost.
+    """
+
+    _BUFFER.flush()
+
+
+atexit.register(flush)
@@ -1,35 +1,96 @@
 import os
 import json
+import asyncio
+import logging
 import re
 import hmac
 import hashlib
 import sqlite3
 import smtplib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from email.message import EmailMessage
 from typing import List, Optional, Any, Dict
 
+import httpx
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, EmailStr, field_validator
-from openai import OpenAI
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, field_validator
+from openai import AsyncOpenAI
 import razorpay
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+def env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name, "").strip().lower()
+    if not value:
+        return default
+    return value not in ("0", "false", "no", "off")
+
 # =========================================================
 # APP
 # =========================================================
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib encoder."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+async def warm_openai():
+    # Free call that opens the pooled TLS connection before the first user
+    try:
+        await client.with_options(timeout=5.0, max_retries=0).models.list()
+    except Exception as e:
+        logger.info("OpenAI warmup skipped: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    warmup = asyncio.create_task(warm_openai()) if client and OPENAI_WARMUP else None
+    yield
+    if warmup:
+        warmup.cancel()
+    pending = list(_background_tasks)
+    if pending:
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*pending, return_exceptions=True),
+                SHUTDOWN_GRACE_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Shutdown grace expired with %d background tasks running; cancelled", len(pending))
+    # Shared OpenAI transport is released once requests and detached work are done
+    await openai_http.aclose()
+
+
 app = FastAPI(
     title="HKE Backend - AI Planner + Razorpay + Booking Save",
-    version="7.0.0"
+    version="7.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# Comma-separated list, parsed once. With "*" and credentials allowed,
+# Starlette echoes the request Origin and sends
+# Access-Control-Allow-Credentials: true. CORS_ALLOW_CREDENTIALS=false
+# makes it answer with a plain "*" instead.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()] or ["*"]
+CORS_ALLOW_CREDENTIALS = env_flag("CORS_ALLOW_CREDENTIALS", True)
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=["*"] if "*" in CORS_ORIGINS else CORS_ORIGINS,
+    allow_credentials=CORS_ALLOW_CREDENTIALS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -39,6 +100,12 @@ app.add_middleware(
 # =========================================================
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5.4-mini").strip()
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+OPENAI_WARMUP = env_flag("OPENAI_WARMUP", True)
+# How long shutdown waits for detached work (stream generations and
+# their enquiry emails) before the OpenAI transport is closed
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "60"))
 
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID", "").strip()
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET", "").strip()
@@ -51,7 +118,34 @@ SMTP_USER = os.getenv("SMTP_USER", "").strip()
 SMTP_PASS = os.getenv("SMTP_PASS", "").strip()
 ENQUIRY_RECEIVER = os.getenv("ENQUIRY_RECEIVER", "").strip()
 
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "1024"))
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "86400"))
+
+# Caps on input that is forwarded to the model (billed per token).
+# Anything over a cap is refused with 413 before OpenAI is called.
+MAX_INSTRUCTION_CHARS = 2000
+MAX_ITINERARY_CHARS = 60000
+# Serialized planner request / chat customer_details
+MAX_DETAILS_CHARS = 8000
+
+# One pooled HTTP/2 connection set shared by every OpenAI call
+# Slow calls are capped so a stuck request falls back instead of hanging
+openai_timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=3.0)
+openai_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    timeout=openai_timeout,
+)
+client = (
+    AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=openai_http,
+        timeout=openai_timeout,
+        max_retries=OPENAI_MAX_RETRIES,
+    )
+    if OPENAI_API_KEY
+    else None
+)
 rz_client = (
     razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
     if RAZORPAY_KEY_ID and RAZORPAY_KEY_SECRET
@@ -104,10 +198,41 @@ def init_db():
     conn.commit()
     conn.close()
 
+# =========================================================
+# AI RESPONSE CACHE
+# =========================================================
+# prompt sha256 -> (expires_at, parsed itinerary), oldest first
+_ai_cache: "OrderedDict[str, tuple]" = OrderedDict()
+# prompt sha256 -> model call still in progress for that prompt
+_ai_inflight: Dict[str, asyncio.Future] = {}
 
-@app.on_event("startup")
-def startup_event():
-    init_db()
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def ai_cache_get(key: str) -> Optional[dict]:
+    hit = _ai_cache.get(key)
+    if not hit:
+        return None
+
+    expires_at, value = hit
+    if expires_at < time.monotonic():
+        _ai_cache.pop(key, None)
+        return None
+
+    _ai_cache.move_to_end(key)
+    return value
+
+
+def ai_cache_set(key: str, value: dict):
+    if AI_CACHE_SIZE <= 0:
+        return
+
+    _ai_cache[key] = (time.monotonic() + AI_CACHE_TTL, value)
+    _ai_cache.move_to_end(key)
+    while len(_ai_cache) > AI_CACHE_SIZE:
+        _ai_cache.popitem(last=False)
 
 # =========================================================
 # HELPERS
@@ -164,14 +289,43 @@ def try_parse_json(text: str) -> Optional[dict]:
     return None
 
 
-def call_openai_json(prompt: str) -> dict:
+async def call_openai_json(prompt: str, text_format: Optional[dict] = None, use_cache: bool = True) -> dict:
+    key = prompt_hash(prompt)
+    if use_cache:
+        cached = ai_cache_get(key)
+        if cached:
+            return cached
+
+        # Same prompt already being generated: wait for that call instead
+        pending = _ai_inflight.get(key)
+        if pending:
+            return await asyncio.shield(pending)
+
+    task = asyncio.ensure_future(request_openai_json(prompt, text_format))
+    _ai_inflight[key] = task
+
+    def finish(t: asyncio.Future):
+        if _ai_inflight.get(key) is t:
+            del _ai_inflight[key]
+        if not t.cancelled() and t.exception() is None:
+            ai_cache_set(key, t.result())
+
+    task.add_done_callback(finish)
+
+    # shield: a disconnecting client must not cancel the call other
+    # requests are waiting on
+    return await asyncio.shield(task)
+
+
+async def request_openai_json(prompt: str, text_format: Optional[dict] = None) -> dict:
     if not client:
         raise RuntimeError("OPENAI_API_KEY not configured")
 
-    resp = client.responses.create(
+    resp = await client.responses.create(
         model=OPENAI_MODEL,
         input=prompt,
         max_output_tokens=3800,
+        **({"text": {"format": text_format}} if text_format else {}),
     )
 
     text = extract_text_from_response(resp)
@@ -183,39 +337,125 @@ def call_openai_json(prompt: str) -> dict:
     return parsed
 
 
-def send_itinerary_enquiry_email(customer_data: dict, itinerary: Optional[dict] = None):
-    if not SMTP_HOST or not SMTP_USER or not SMTP_PASS or not ENQUIRY_RECEIVER:
-        print("Email skipped: SMTP settings not configured")
-        return
+async def stream_openai_text(prompt: str, text_format: Optional[dict] = None):
+    if not client:
+        raise RuntimeError("OPENAI_API_KEY not configured")
+
+    async with client.responses.stream(
+        model=OPENAI_MODEL,
+        input=prompt,
+        max_output_tokens=3800,
+        **({"text": {"format": text_format}} if text_format else {}),
+    ) as stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+# Strong references to detached tasks so they are not garbage collected
+_background_tasks = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def stream_openai_json(
+    prompt: str,
+    on_error,
+    on_done=None,
+    text_format: Optional[dict] = None,
+    use_cache: bool = True,
+):
+    """
+    Yields "delta" SSE events while the model writes, then a single "done"
+    event carrying the same payload the non-streaming endpoint returns.
+    A cached itinerary skips straight to the "done" event.
+    on_error(e) builds the fallback payload; if that fails too, an
+    "error" event ends the stream instead. When on_done(payload) is
+    given, generation runs as a detached task that awaits it after the
+    final event, so it still runs if the client disconnects mid-stream
+    and never holds the response open.
+    """
+    events = asyncio.Queue()
+
+    async def build():
+        key = prompt_hash(prompt)
+        cached = ai_cache_get(key) if use_cache else None
+        if cached:
+            return {"ok": True, "source": "openai", "itinerary": cached}
+
+        parts = []
+        try:
+            async for delta in stream_openai_text(prompt, text_format):
+                parts.append(delta)
+                events.put_nowait(sse_event("delta", {"delta": delta}))
+
+            itinerary = try_parse_json("".join(parts).strip())
+            if not itinerary:
+                raise ValueError("Invalid JSON returned by model")
+        except Exception as e:
+            return on_error(e)
+
+        ai_cache_set(key, itinerary)
+        return {"ok": True, "source": "openai", "itinerary": itinerary}
+
+    async def produce():
+        try:
+            result = await build()
+            events.put_nowait(sse_event("done", result))
+        except Exception:
+            logger.exception("AI stream failed")
+            events.put_nowait(sse_event("error", {"ok": False, "detail": "Internal Server Error"}))
+            return
+        finally:
+            # Always end the response, whatever happened above
+            events.put_nowait(None)
+
+        if on_done:
+            await on_done(result)
+
+    producer = spawn(produce())
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield event
+    finally:
+        # Nothing depends on the result once the client is gone
+        if on_done is None and not producer.done():
+            producer.cancel()
+
+
+def wants_event_stream(request: Request, stream: Optional[bool]) -> bool:
+    # An explicit ?stream= wins; otherwise follow the Accept header
+    if stream is not None:
+        return stream
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+def ensure_within(value: str, limit: int, what: str):
+    if len(value) > limit:
+        raise HTTPException(status_code=413, detail=f"{what} must be at most {limit} characters")
+
 
-    name = safe_str(customer_data.get("name"))
-    email = safe_str(customer_data.get("email"))
-    phone = safe_str(customer_data.get("phone"))
-    from_location = safe_str(customer_data.get("fromLocation"))
-    destination = safe_str(customer_data.get("destination"))
-    end_point = safe_str(customer_data.get("endPoint"))
-    start_date = safe_str(customer_data.get("startDate"))
-    end_date = safe_str(customer_data.get("endDate"))
-    days = safe_str(customer_data.get("days"))
-    travellers = safe_str(customer_data.get("travellers"))
-    rooms = safe_str(customer_data.get("rooms"))
-    budget = safe_str(customer_data.get("budget"))
-    travel_type = safe_str(customer_data.get("travelType"))
-    hotel_class = safe_str(customer_data.get("hotelClass"))
-    vehicle = safe_str(customer_data.get("vehicle"))
-    guide = safe_str(customer_data.get("guide"))
-    need_food = bool(customer_data.get("needFood"))
-    food_preference = safe_str(customer_data.get("foodPreference"))
-    travel_style = ", ".join(customer_data.get("travelStyle", []))
-    places = ", ".join(customer_data.get("places", []))
-    notes = safe_str(customer_data.get("notes"))
-
-    itinerary_title = safe_str((itinerary or {}).get("title"))
-    itinerary_summary = safe_str((itinerary or {}).get("summary"))
-
-    subject = f"New AI Planner Enquiry - {destination} - {name}"
-
-    body = f"""
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Vary": "Accept"},
+    )
+
+
+ENQUIRY_EMAIL_TEMPLATE = """
 New AI Planner enquiry received from Himalayan Kerala Expeditions.
 
 Customer Details
@@ -242,7 +482,7 @@ Travel Type: {travel_type}
 Hotel Category: {hotel_class}
 Vehicle: {vehicle}
 Guide: {guide}
-Need Food: {"Yes" if need_food else "No"}
+Need Food: {need_food}
 Food Preference: {food_preference}
 Travel Style: {travel_style}
 Selected Tourist Places: {places}
@@ -260,11 +500,54 @@ Generated Itinerary Summary
 {itinerary_summary}
 """.strip()
 
+
+# (template field, customer_data key) for the plain text fields
+ENQUIRY_TEXT_FIELDS = (
+    ("name", "name"),
+    ("email", "email"),
+    ("phone", "phone"),
+    ("from_location", "fromLocation"),
+    ("destination", "destination"),
+    ("end_point", "endPoint"),
+    ("start_date", "startDate"),
+    ("end_date", "endDate"),
+    ("days", "days"),
+    ("travellers", "travellers"),
+    ("rooms", "rooms"),
+    ("budget", "budget"),
+    ("travel_type", "travelType"),
+    ("hotel_class", "hotelClass"),
+    ("vehicle", "vehicle"),
+    ("guide", "guide"),
+    ("food_preference", "foodPreference"),
+    ("notes", "notes"),
+)
+
+
+def send_itinerary_enquiry_email(customer_data: dict, itinerary: Optional[dict] = None):
+    if not SMTP_HOST or not SMTP_USER or not SMTP_PASS or not ENQUIRY_RECEIVER:
+        logger.info("Email skipped: SMTP settings not configured")
+        return
+
+    fields = {field: safe_str(customer_data.get(key)) for field, key in ENQUIRY_TEXT_FIELDS}
+    itinerary = itinerary or {}
+
+    subject = f"New AI Planner Enquiry - {fields['destination']} - {fields['name']}"
+
+    body = ENQUIRY_EMAIL_TEMPLATE.format(
+        need_food="Yes" if customer_data.get("needFood") else "No",
+        travel_style=", ".join(customer_data.get("travelStyle", [])),
+        places=", ".join(customer_data.get("places", [])),
+        itinerary_title=safe_str(itinerary.get("title")),
+        itinerary_summary=safe_str(itinerary.get("summary")),
+        **fields,
+    )
+
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = SMTP_USER
     msg["To"] = ENQUIRY_RECEIVER
-    msg["Reply-To"] = email if email else SMTP_USER
+    msg["Reply-To"] = fields["email"] or SMTP_USER
     msg.set_content(body)
 
     with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
@@ -273,79 +556,17 @@ Generated Itinerary Summary
         server.send_message(msg)
 
 
-def build_itinerary_prompt(data: dict) -> str:
-    return f"""
+# Prompt templates are compiled once at import; only the customer data
+# is substituted per request. The output shape comes from the JSON schema.
+ITINERARY_PROMPT_TEMPLATE = """
 You are a senior luxury travel consultant and itinerary designer for Himalayan Kerala Expeditions, a premium Indian travel company.
 
 Your job is to create a highly polished, customer-facing itinerary that feels like it was prepared by an experienced travel executive with deep destination knowledge.
 
 Customer trip request:
-{json.dumps(data, ensure_ascii=False, indent=2)}
-
-Return ONLY valid JSON in this exact structure:
-{{
-  "title": "string",
-  "summary": "A polished 3 to 5 line professional trip introduction written like a premium travel consultant",
-  "meta": {{
-    "destination": "string",
-    "route": "string",
-    "dates": "string",
-    "travellers": "string",
-    "rooms": "string",
-    "tripStyle": "string"
-  }},
-  "extraInfo": {{
-    "budget": "string",
-    "travelType": "string",
-    "hotel": "string",
-    "vehicle": "string",
-    "guide": "string",
-    "food": "string",
-    "style": "string",
-    "notes": "string"
-  }},
-  "highlights": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "inclusions": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "exclusions": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "terms": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "days": [
-    {{
-      "day": 1,
-      "date": "YYYY-MM-DD",
-      "title": "string",
-      "route": "string",
-      "hotel": "string",
-      "meals": "string",
-      "activities": [
-        "string",
-        "string",
-        "string",
-        "string"
-      ],
-      "notes": "string"
-    }}
-  ]
-}}
+{customer_request}
+
+Return ONLY valid JSON matching the provided itinerary schema.
 
 Rules:
 - Write like a highly experienced senior travel agent, not like a bot.
@@ -367,12 +588,17 @@ Rules:
 """.strip()
 
 
-def build_edit_prompt(current_itinerary: str, instruction: str, customer_details: dict) -> str:
-    return f"""
+def build_itinerary_prompt(data: dict) -> str:
+    return ITINERARY_PROMPT_TEMPLATE.format(
+        customer_request=json.dumps(data, ensure_ascii=False, indent=2)
+    )
+
+
+EDIT_PROMPT_TEMPLATE = """
 You are a senior luxury travel consultant updating an already prepared itinerary for Himalayan Kerala Expeditions.
 
 Customer details:
-{json.dumps(customer_details, ensure_ascii=False, indent=2)}
+{customer_details}
 
 Current itinerary JSON:
 {current_itinerary}
@@ -380,71 +606,7 @@ Current itinerary JSON:
 Customer edit instruction:
 {instruction}
 
-Return ONLY valid JSON in this exact structure:
-{{
-  "title": "string",
-  "summary": "A polished 3 to 5 line professional trip introduction",
-  "meta": {{
-    "destination": "string",
-    "route": "string",
-    "dates": "string",
-    "travellers": "string",
-    "rooms": "string",
-    "tripStyle": "string"
-  }},
-  "extraInfo": {{
-    "budget": "string",
-    "travelType": "string",
-    "hotel": "string",
-    "vehicle": "string",
-    "guide": "string",
-    "food": "string",
-    "style": "string",
-    "notes": "string",
-    "editNote": "string"
-  }},
-  "highlights": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "inclusions": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "exclusions": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "terms": [
-    "string",
-    "string",
-    "string",
-    "string"
-  ],
-  "days": [
-    {{
-      "day": 1,
-      "date": "YYYY-MM-DD",
-      "title": "string",
-      "route": "string",
-      "hotel": "string",
-      "meals": "string",
-      "activities": [
-        "string",
-        "string",
-        "string",
-        "string"
-      ],
-      "notes": "string"
-    }}
-  ]
-}}
+Return ONLY valid JSON matching the provided itinerary schema.
 
 Rules:
 - Apply the customer change properly.
@@ -456,6 +618,14 @@ Rules:
 """.strip()
 
 
+def build_edit_prompt(current_itinerary: str, instruction: str, customer_details: dict) -> str:
+    return EDIT_PROMPT_TEMPLATE.format(
+        customer_details=json.dumps(customer_details, ensure_ascii=False, indent=2),
+        current_itinerary=current_itinerary,
+        instruction=instruction,
+    )
+
+
 def fallback_itinerary(data: dict, edit_note: str = "") -> dict:
     places = data.get("places") or ["Local Sightseeing"]
     days = max(2, int(data.get("days") or 5))
@@ -599,7 +769,14 @@ def verify_razorpay_signature(order_id: str, payment_id: str, signature: str) ->
 # =========================================================
 # MODELS
 # =========================================================
+# Request bodies are read-only once parsed; unknown keys are dropped
+# and surrounding whitespace is stripped during validation.
+REQUEST_MODEL_CONFIG = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
+
 class PlannerRequest(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     name: str
     email: EmailStr
     phone: str
@@ -621,6 +798,7 @@ class PlannerRequest(BaseModel):
     travelStyle: List[str] = Field(default_factory=list)
     places: List[str] = Field(default_factory=list)
     notes: Optional[str] = ""
+    nocache: bool = False
 
     @field_validator("phone")
     @classmethod
@@ -633,9 +811,10 @@ class PlannerRequest(BaseModel):
     @field_validator("name", "fromLocation", "destination", "endPoint")
     @classmethod
     def validate_required_strings(cls, v):
-        if not isinstance(v, str) or not v.strip():
+        # Already stripped by str_strip_whitespace
+        if not v:
             raise ValueError("This field is required")
-        return v.strip()
+        return v
 
     @field_validator("travelStyle", mode="before")
     @classmethod
@@ -667,6 +846,8 @@ class PlannerRequest(BaseModel):
 
 
 class ChatEditRequest(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     instruction: Optional[str] = ""
     message: Optional[str] = ""
     current_itinerary: Optional[str] = ""
@@ -676,6 +857,8 @@ class ChatEditRequest(BaseModel):
 
 
 class RazorpayOrderRequest(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     amount: float = Field(..., gt=0)
     currency: str = "INR"
     receipt: Optional[str] = ""
@@ -695,17 +878,101 @@ class RazorpayOrderRequest(BaseModel):
 
 
 class RazorpayVerifyRequest(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     razorpay_order_id: str
     razorpay_payment_id: str
     razorpay_signature: str
 
 
 class SavePaymentRequest(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     customer: Dict[str, Any]
     itinerary: Dict[str, Any]
     pricing: Dict[str, Any]
     payment: Dict[str, Any]
 
+# ---------------------------------------------------------
+# AI output schema (sent to OpenAI as a strict JSON schema)
+# ---------------------------------------------------------
+# extra="forbid" emits additionalProperties: false, as strict mode requires
+ITINERARY_MODEL_CONFIG = ConfigDict(extra="forbid")
+
+
+class ItineraryMeta(BaseModel):
+    model_config = ITINERARY_MODEL_CONFIG
+
+    destination: str
+    route: str
+    dates: str
+    travellers: str
+    rooms: str
+    tripStyle: str
+
+
+class ItineraryExtraInfo(BaseModel):
+    model_config = ITINERARY_MODEL_CONFIG
+
+    budget: str
+    travelType: str
+    hotel: str
+    vehicle: str
+    guide: str
+    food: str
+    style: str
+    notes: str
+
+
+class EditedItineraryExtraInfo(ItineraryExtraInfo):
+    editNote: str
+
+
+class ItineraryDay(BaseModel):
+    model_config = ITINERARY_MODEL_CONFIG
+
+    day: int
+    date: str = Field(description="YYYY-MM-DD")
+    title: str
+    route: str
+    hotel: str
+    meals: str
+    activities: List[str] = Field(description="4 to 6 detailed activity points")
+    notes: str
+
+
+class Itinerary(BaseModel):
+    model_config = ITINERARY_MODEL_CONFIG
+
+    title: str
+    summary: str = Field(
+        description="A polished 3 to 5 line professional trip introduction written like a premium travel consultant"
+    )
+    meta: ItineraryMeta
+    extraInfo: ItineraryExtraInfo
+    highlights: List[str] = Field(description="At least 4 points")
+    inclusions: List[str] = Field(description="At least 4 points")
+    exclusions: List[str] = Field(description="At least 4 points")
+    terms: List[str] = Field(description="At least 4 points")
+    days: List[ItineraryDay]
+
+
+class EditedItinerary(Itinerary):
+    extraInfo: EditedItineraryExtraInfo
+
+
+def json_schema_format(name: str, model: type) -> dict:
+    return {
+        "type": "json_schema",
+        "name": name,
+        "schema": model.model_json_schema(),
+        "strict": True,
+    }
+
+
+ITINERARY_FORMAT = json_schema_format("itinerary", Itinerary)
+EDITED_ITINERARY_FORMAT = json_schema_format("edited_itinerary", EditedItinerary)
+
 # =========================================================
 # ROUTES
 # =========================================================
@@ -738,22 +1005,48 @@ def payment_config():
     }
 
 
+async def notify_enquiry(data: dict, itinerary: Optional[dict]):
+    try:
+        await asyncio.to_thread(send_itinerary_enquiry_email, data, itinerary)
+    except Exception as email_error:
+        logger.warning("Failed to send enquiry email: %s", email_error)
+
+
 @app.post("/api/ai/itinerary")
-def generate_itinerary(payload: PlannerRequest):
-    data = payload.model_dump()
+async def generate_itinerary(payload: PlannerRequest, request: Request, response: Response, stream: Optional[bool] = None):
+    # JSON and SSE share the URL, so caches must key on Accept
+    response.headers["Vary"] = "Accept"
+    data = payload.model_dump(exclude={"nocache"})
+    use_cache = not payload.nocache
+    ensure_within(safe_str(payload.notes), MAX_INSTRUCTION_CHARS, "Notes")
+    ensure_within(json.dumps(data, ensure_ascii=False), MAX_DETAILS_CHARS, "Trip details")
+
+    if wants_event_stream(request, stream):
+        def on_error(e):
+            logger.warning("AI itinerary fallback used: %s", e)
+            return {"ok": True, "source": "fallback", "itinerary": fallback_itinerary(data)}
+
+        return sse_response(stream_openai_json(
+            build_itinerary_prompt(data),
+            on_error,
+            on_done=lambda result: notify_enquiry(data, result["itinerary"]),
+            text_format=ITINERARY_FORMAT,
+            use_cache=use_cache,
+        ))
 
     try:
-        itinerary = call_openai_json(build_itinerary_prompt(data))
+        itinerary = await call_openai_json(
+            build_itinerary_prompt(data),
+            text_format=ITINERARY_FORMAT,
+            use_cache=use_cache,
+        )
         source = "openai"
     except Exception as e:
         itinerary = fallback_itinerary(data)
         source = "fallback"
-        print(f"AI itinerary fallback used: {e}")
+        logger.warning("AI itinerary fallback used: %s", e)
 
-    try:
-        send_itinerary_enquiry_email(data, itinerary)
-    except Exception as email_error:
-        print(f"Failed to send enquiry email: {email_error}")
+    await notify_enquiry(data, itinerary)
 
     return {
         "ok": True,
@@ -763,8 +1056,9 @@ def generate_itinerary(payload: PlannerRequest):
 
 
 @app.post("/api/ai/chat")
-def edit_itinerary(payload: ChatEditRequest):
-    instruction = safe_str(payload.instruction) or safe_str(payload.message)
+async def edit_itinerary(payload: ChatEditRequest, request: Request, response: Response, stream: Optional[bool] = None):
+    response.headers["Vary"] = "Accept"
+    instruction = " ".join((safe_str(payload.instruction) or safe_str(payload.message)).split())
     current_itinerary = safe_str(payload.current_itinerary) or safe_str(payload.itinerary)
     customer_details = payload.customer_details or payload.context or {}
 
@@ -772,10 +1066,29 @@ def edit_itinerary(payload: ChatEditRequest):
         raise HTTPException(status_code=400, detail="Edit instruction is required")
     if not current_itinerary:
         raise HTTPException(status_code=400, detail="Current itinerary is required")
+    ensure_within(instruction, MAX_INSTRUCTION_CHARS, "Edit instruction")
+    ensure_within(current_itinerary, MAX_ITINERARY_CHARS, "Current itinerary")
+    ensure_within(json.dumps(customer_details, ensure_ascii=False), MAX_DETAILS_CHARS, "Customer details")
+
+    if wants_event_stream(request, stream):
+        def on_error(e):
+            return {
+                "ok": True,
+                "source": "fallback",
+                "warning": str(e),
+                "itinerary": fallback_itinerary(customer_details, edit_note=instruction)
+            }
+
+        return sse_response(stream_openai_json(
+            build_edit_prompt(current_itinerary, instruction, customer_details),
+            on_error,
+            text_format=EDITED_ITINERARY_FORMAT,
+        ))
 
     try:
-        itinerary = call_openai_json(
-            build_edit_prompt(current_itinerary, instruction, customer_details)
+        itinerary = await call_openai_json(
+            build_edit_prompt(current_itinerary, instruction, customer_details),
+            text_format=EDITED_ITINERARY_FORMAT,
         )
         return {"ok": True, "source": "openai", "itinerary": itinerary}
     except Exception as e:
@@ -945,9 +1258,13 @@ def list_payments():
 if __name__ == "__main__":
     import uvicorn
 
+    # loop/http stay "auto": uvicorn[standard] installs uvloop + httptools
+    # and auto picks them wherever they are available
+    dev = env_flag("DEV", False)
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=int(os.getenv("PORT", "8000")),
-        reload=True
+        reload=dev,
+        workers=1 if dev else int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
     )
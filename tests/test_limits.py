@@ -0,0 +1,55 @@
+import unittest
+
+from fastapi.testclient import TestClient
+
+import main
+
+PLANNER = {
+    "name": "Asha",
+    "email": "asha@example.com",
+    "phone": "9876543210",
+    "fromLocation": "Kochi",
+    "destination": "Munnar",
+    "endPoint": "Kochi",
+    "startDate": "2026-11-01",
+    "days": 4,
+    "endDate": "2026-11-04",
+    "places": ["Munnar"],
+}
+
+CHAT = {"instruction": "Add a houseboat night", "current_itinerary": "{}"}
+
+
+class InputLimitTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(main.app)
+
+    def assertTooLarge(self, path: str, body: dict):
+        response = self.client.post(path, json=body)
+        self.assertEqual(response.status_code, 413, response.text)
+
+    def test_planner_notes(self):
+        self.assertTooLarge("/api/ai/itinerary", {**PLANNER, "notes": "x" * (main.MAX_INSTRUCTION_CHARS + 1)})
+
+    def test_planner_text_fields(self):
+        self.assertTooLarge("/api/ai/itinerary", {**PLANNER, "destination": "x" * main.MAX_DETAILS_CHARS})
+
+    def test_planner_lists(self):
+        self.assertTooLarge("/api/ai/itinerary", {**PLANNER, "places": ["Munnar"] * main.MAX_DETAILS_CHARS})
+
+    def test_chat_instruction(self):
+        self.assertTooLarge("/api/ai/chat", {**CHAT, "instruction": "x" * (main.MAX_INSTRUCTION_CHARS + 1)})
+
+    def test_chat_current_itinerary(self):
+        self.assertTooLarge("/api/ai/chat", {**CHAT, "current_itinerary": "x" * (main.MAX_ITINERARY_CHARS + 1)})
+
+    def test_chat_customer_details(self):
+        self.assertTooLarge("/api/ai/chat", {**CHAT, "context": {"notes": "x" * main.MAX_DETAILS_CHARS}})
+
+    def test_streaming_requests_are_capped_too(self):
+        self.assertTooLarge("/api/ai/chat?stream=1", {**CHAT, "customer_details": {"notes": "x" * main.MAX_DETAILS_CHARS}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import threading
+import unittest
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+async def failing_stream(prompt, text_format=None):
+    raise RuntimeError("model unavailable")
+    yield  # pragma: no cover
+
+
+def read_events(response) -> list:
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], main.orjson.loads(lines["data"])))
+    return events
+
+
+class StreamTests(unittest.TestCase):
+    def setUp(self):
+        self._stream = main.stream_openai_text
+        main.stream_openai_text = failing_stream
+        main._ai_cache.clear()
+
+    def tearDown(self):
+        main.stream_openai_text = self._stream
+
+    def post(self, path: str, body: dict):
+        # A stream that never ends would hang the test run, so bound it
+        result = {}
+
+        def run():
+            with TestClient(main.app) as client:
+                result["response"] = client.post(path, json=body)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        worker.join(timeout=10)
+        self.assertFalse(worker.is_alive(), "stream response never finished")
+        return result["response"]
+
+    def test_fallback_sent_as_done_event(self):
+        response = self.post("/api/ai/chat?stream=1", {
+            "instruction": "Add a houseboat night",
+            "current_itinerary": "{}",
+            "customer_details": {"days": 4, "destination": "Alleppey"},
+        })
+
+        self.assertEqual(response.status_code, 200)
+        event, data = read_events(response)[-1]
+        self.assertEqual(event, "done")
+        self.assertEqual(data["source"], "fallback")
+
+    def test_failing_fallback_ends_stream_with_error_event(self):
+        response = self.post("/api/ai/chat?stream=1", {
+            "instruction": "Add a houseboat night",
+            "current_itinerary": "{}",
+            "customer_details": {"days": "five"},
+        })
+
+        self.assertEqual(response.status_code, 200)
+        event, data = read_events(response)[-1]
+        self.assertEqual(event, "error")
+        self.assertFalse(data["ok"])
+
+
+if __name__ == "__main__":
+    unittest.main()